@@ -1,20 +1,25 @@
+import asyncio
+import hashlib
+import hmac
+import logging
 import os
-import secrets
 import string
 from datetime import datetime, timedelta, timezone
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 
-import requests
-from fastapi import FastAPI, HTTPException, Depends, Header
+import httpx
+from cachetools import TTLCache
+from fastapi import FastAPI, HTTPException, Depends, Header, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
 
 from database import db, create_document, get_documents
 from schemas import (
     User,
-    Instance,
-    Message,
     Webhook,
     OTPRequest,
     OTPVerify,
@@ -23,7 +28,9 @@ from schemas import (
     RegisterWebhook,
 )
 
-app = FastAPI(title="Sab Tech WhatsApp API Demo")
+logger = logging.getLogger(__name__)
+
+app = FastAPI(title="Sab Tech WhatsApp API Demo", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -36,21 +43,63 @@ app.add_middleware(
 
 # ---------- Utilities ----------
 
+def _sampling_table(alphabet: str) -> Tuple[bytes, bytes]:
+    # Map each byte to alphabet[b % n], dropping bytes >= the largest multiple
+    # of n (rejection sampling) so every character stays equally likely.
+    n = len(alphabet)
+    limit = 256 - 256 % n
+    table = bytes(ord(alphabet[b % n]) if b < limit else 0 for b in range(256))
+    return table, bytes(range(limit, 256))
+
+
+def _random_string(sampling: Tuple[bytes, bytes], length: int) -> str:
+    table, reject = sampling
+    out = b""
+    while len(out) < length:
+        # One urandom read translated in C. At most 8/256 bytes are rejected for
+        # our alphabets, so a fixed 16-byte margin makes a second read rare.
+        out += os.urandom(length - len(out) + 16).translate(table, reject)
+    return out[:length].decode("ascii")
+
+
+_CODE_SAMPLING = _sampling_table(string.digits)
+_TOKEN_SAMPLING = _sampling_table(string.ascii_letters + string.digits)
+
+
 def _random_code(length: int = 6) -> str:
-    return "".join(secrets.choice(string.digits) for _ in range(length))
+    return _random_string(_CODE_SAMPLING, length)
 
 
 def _random_token(length: int = 40) -> str:
-    alphabet = string.ascii_letters + string.digits
-    return "".join(secrets.choice(alphabet) for _ in range(length))
+    return _random_string(_TOKEN_SAMPLING, length)
+
+
+def _secure_equals(expected: Optional[str], given: str) -> bool:
+    # Constant-time comparison; bytes so non-ASCII input can't raise. A missing
+    # stored secret never matches, not even an empty one.
+    return expected is not None and hmac.compare_digest(expected.encode(), given.encode())
 
 
 def _collection(name: str):
     return db[name]
 
 
-def _user_from_token(token: str) -> Optional[Dict[str, Any]]:
-    return _collection("user").find_one({"access_tokens": token})
+# Bearer token -> user document. Keyed by a digest so raw tokens are not kept in memory.
+_token_cache: TTLCache = TTLCache(maxsize=10000, ttl=30)
+
+
+async def _user_from_token(token: str) -> Optional[Dict[str, Any]]:
+    key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    user = _token_cache.get(key)
+    if user is not None:
+        return user
+    # Callers only need the user's _id; skip the token array and OTP fields
+    user = await _collection("user").find_one({"access_tokens": token}, {"_id": 1})
+    if user is not None:
+        # Stringify once per cache fill rather than once per request
+        user["_id_str"] = str(user["_id"])
+        _token_cache[key] = user
+    return user
 
 
 async def get_current_user(authorization: Optional[str] = Header(None)) -> Dict[str, Any]:
@@ -59,12 +108,124 @@ async def get_current_user(authorization: Optional[str] = Header(None)) -> Dict[
     scheme, _, token = authorization.partition(" ")
     if scheme.lower() != "bearer" or not token:
         raise HTTPException(status_code=401, detail="Invalid Authorization header")
-    user = _user_from_token(token)
+    user = await _user_from_token(token)
     if not user:
         raise HTTPException(status_code=401, detail="Invalid or expired token")
     return user
 
 
+async def get_current_user_id(current_user: Dict[str, Any] = Depends(get_current_user)) -> str:
+    # Handlers only key data by the owner's id; hand them the string form directly
+    return current_user["_id_str"]
+
+
+# ---------- Lifecycle ----------
+
+@app.on_event("startup")
+async def prepare_database():
+    if db is None:
+        return
+    # Establish pool connections before the first request arrives
+    try:
+        await db.command("ping")
+    except PyMongoError as e:
+        # Don't block startup; /test reports the problem. Skip the index
+        # builds too, each would wait out its own server-selection timeout.
+        logger.warning("Database ping failed, skipping index setup: %s", e)
+        return
+    # Indexes for the predicates used on every request path
+    await _ensure_index("user", "access_tokens")
+    await _ensure_index("user", [("email", 1)], unique=True, sparse=True)
+    await _ensure_index("user", [("phone", 1)], unique=True, sparse=True)
+    await _ensure_index("instance", [("instance_id", 1)], unique=True)
+    await _ensure_index("instance", [("user_id", 1), ("_id", 1)])
+    await _ensure_index("message", [("message_id", 1)], unique=True)
+    await _ensure_index("webhook", "instance_id")
+    await _ensure_index("user", "otp_expires_at", sparse=True)
+
+
+async def _ensure_index(name: str, keys, **kwargs):
+    try:
+        await _collection(name).create_index(keys, **kwargs)
+    except PyMongoError as e:
+        # Don't block startup on a conflicting or unbuildable index
+        logger.warning("Could not create index on %s %s: %s", name, keys, e)
+
+
+# Shared client so webhook deliveries reuse keep-alive connections
+http_client: Optional[httpx.AsyncClient] = None
+
+# Webhook events are queued by request handlers and drained by background workers
+WEBHOOK_WORKERS = 4
+WEBHOOK_BATCH_SIZE = 32
+WEBHOOK_QUEUE_SIZE = 10000
+WEBHOOK_DRAIN_SECONDS = 5
+# Created on startup so the queue belongs to the running event loop
+webhook_q: "Optional[asyncio.Queue[Tuple[str, str, dict]]]" = None
+webhook_stats = {"enqueued": 0, "dropped": 0, "delivered": 0, "failed": 0}
+_webhook_workers: List[asyncio.Task] = []
+
+
+@app.on_event("startup")
+async def start_webhook_dispatch():
+    global http_client, webhook_q
+    http_client = httpx.AsyncClient(timeout=3.0, limits=httpx.Limits(max_keepalive_connections=100))
+    webhook_q = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+    for _ in range(WEBHOOK_WORKERS):
+        _webhook_workers.append(asyncio.create_task(_webhook_worker(webhook_q)))
+
+
+@app.on_event("shutdown")
+async def stop_webhook_dispatch():
+    global webhook_q
+    # Drain: give queued and in-flight events a short window to go out, then
+    # cancel the workers and count whatever is still queued as dropped.
+    if webhook_q is not None:
+        try:
+            await asyncio.wait_for(webhook_q.join(), timeout=WEBHOOK_DRAIN_SECONDS)
+        except asyncio.TimeoutError:
+            logger.warning("Webhook queue not drained on shutdown; dropping %d events", webhook_q.qsize())
+        webhook_stats["dropped"] += webhook_q.qsize()
+        webhook_q = None
+    for task in _webhook_workers:
+        task.cancel()
+    await asyncio.gather(*_webhook_workers, return_exceptions=True)
+    _webhook_workers.clear()
+    if http_client is not None:
+        await http_client.aclose()
+
+
+# Expired OTPs are cleared server-side; verify_otp filters on expiry itself
+OTP_SWEEP_INTERVAL_SECONDS = 60
+_otp_sweeper: Optional[asyncio.Task] = None
+
+
+async def _sweep_expired_otps():
+    while True:
+        await asyncio.sleep(OTP_SWEEP_INTERVAL_SECONDS)
+        try:
+            await _collection("user").update_many(
+                {"otp_expires_at": {"$lt": datetime.now(timezone.utc)}},
+                {"$unset": {"otp_code": "", "otp_expires_at": ""}},
+            )
+        except PyMongoError as e:
+            logger.warning("OTP sweep failed: %s", e)
+
+
+@app.on_event("startup")
+async def start_otp_sweeper():
+    global _otp_sweeper
+    if db is not None:
+        _otp_sweeper = asyncio.create_task(_sweep_expired_otps())
+
+
+@app.on_event("shutdown")
+async def stop_otp_sweeper():
+    if _otp_sweeper is not None:
+        _otp_sweeper.cancel()
+        await asyncio.gather(_otp_sweeper, return_exceptions=True)
+
+
 # ---------- Health ----------
 
 @app.get("/")
@@ -73,7 +234,7 @@ def read_root():
 
 
 @app.get("/test")
-def test_database():
+async def test_database():
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -81,6 +242,7 @@ def test_database():
         "database_name": None,
         "connection_status": "Not Connected",
         "collections": [],
+        "webhook_queue": {"depth": webhook_q.qsize() if webhook_q is not None else 0, **webhook_stats},
     }
     try:
         if db is not None:
@@ -89,7 +251,7 @@ def test_database():
             response["database_name"] = db.name or ""
             response["connection_status"] = "Connected"
             try:
-                collections = db.list_collection_names()
+                collections = await db.list_collection_names()
                 response["collections"] = collections[:10]
                 response["database"] = "✅ Connected & Working"
             except Exception as e:
@@ -104,15 +266,14 @@ def test_database():
 # ---------- Auth (OTP) ----------
 
 @app.post("/auth/otp/request")
-def request_otp(payload: OTPRequest):
-    if not payload.email and not payload.phone:
+async def request_otp(payload: OTPRequest):
+    identifier = payload.identifier
+    if not identifier:
         raise HTTPException(status_code=400, detail="Provide email or phone")
-
-    identifier = {"email": payload.email} if payload.email else {"phone": payload.phone}
     code = _random_code()
     expires = datetime.now(timezone.utc) + timedelta(minutes=10)
 
-    _collection("user").update_one(
+    await _collection("user").update_one(
         identifier,
         {
             "$set": {
@@ -126,34 +287,42 @@ def request_otp(payload: OTPRequest):
     )
 
     # In a real app, send via email/SMS. For demo, return code directly.
-    return {"message": "OTP generated", "code": code, "expires_at": expires.isoformat()}
+    return {"message": "OTP generated", "code": code, "expires_at": expires}
 
 
 @app.post("/auth/otp/verify")
-def verify_otp(payload: OTPVerify):
-    if not payload.email and not payload.phone:
+async def verify_otp(payload: OTPVerify):
+    identifier = payload.identifier
+    if not identifier:
         raise HTTPException(status_code=400, detail="Provide email or phone")
-
-    identifier = {"email": payload.email} if payload.email else {"phone": payload.phone}
-    user = _collection("user").find_one(identifier)
-    if not user or not user.get("otp_code"):
-        raise HTTPException(status_code=400, detail="OTP not requested")
-
-    if user["otp_code"] != payload.code:
-        raise HTTPException(status_code=400, detail="Invalid OTP")
-
-    if user.get("otp_expires_at") and datetime.now(timezone.utc) > user["otp_expires_at"]:
-        raise HTTPException(status_code=400, detail="OTP expired")
-
     token = _random_token()
 
-    _collection("user").update_one(
-        {"_id": user["_id"]},
+    # Match, expiry check and consume in one atomic round-trip so an OTP
+    # can only ever be redeemed once. The code is compared by Mongo rather
+    # than _secure_equals; any timing difference there is hidden by the
+    # database round-trip, and the code expires after 10 minutes.
+    user = await _collection("user").find_one_and_update(
         {
-            "$set": {"otp_code": None, "otp_expires_at": None},
-            "$push": {"access_tokens": token},
+            **identifier,
+            "otp_code": payload.code,
+            "otp_expires_at": {"$gt": datetime.now(timezone.utc)},
         },
+        # Pipeline update (MongoDB 4.2+): consume the OTP and append the token
+        # in the same single-document write
+        [
+            {
+                "$set": {
+                    "access_tokens": {"$concatArrays": [{"$ifNull": ["$access_tokens", []]}, [token]]},
+                    "otp_code": None,
+                    "otp_expires_at": None,
+                }
+            }
+        ],
+        projection={"_id": 1},
+        return_document=ReturnDocument.AFTER,
     )
+    if not user:
+        raise HTTPException(status_code=400, detail="Invalid or expired OTP")
 
     return {"access_token": token, "token_type": "bearer"}
 
@@ -161,97 +330,186 @@ def verify_otp(payload: OTPVerify):
 # ---------- Instances ----------
 
 @app.get("/instances")
-def list_instances(current_user: dict = Depends(get_current_user)):
-    instances = list(_collection("instance").find({"user_id": str(current_user["_id"])}))
-    for i in instances:
-        i["_id"] = str(i["_id"])  # stringify for JSON
-    return {"items": instances}
+async def list_instances(
+    skip: int = Query(0, ge=0),
+    limit: int = Query(200, ge=1, le=1000),
+    user_id: str = Depends(get_current_user_id),
+):
+    # Only fetch what the listing shows; the instance token is never returned here.
+    # _id is stringified server-side so documents are JSON-ready as returned.
+    # One extra row is fetched to tell whether another page exists.
+    cursor = _collection("instance").aggregate([
+        {"$match": {"user_id": user_id}},
+        {"$sort": {"_id": 1}},
+        {"$skip": skip},
+        {"$limit": limit + 1},
+        {"$project": {
+            "_id": {"$toString": "$_id"},
+            "instance_id": 1,
+            "name": 1,
+            "is_authenticated": 1,
+            "created_at": 1,
+        }},
+    ])
+    instances = await cursor.to_list(length=limit + 1)
+    has_more = len(instances) > limit
+    return {"items": instances[:limit], "next_skip": skip + limit if has_more else None}
 
 
 @app.post("/instances")
-def create_instance(payload: InstanceCreate, current_user: dict = Depends(get_current_user)):
+async def create_instance(payload: InstanceCreate, user_id: str = Depends(get_current_user_id)):
     instance_id = _random_token(10)
     token = _random_token(32)
-    doc = Instance(
-        user_id=str(current_user["_id"]),
-        name=payload.name,
-        instance_id=instance_id,
-        token=token,
-        is_authenticated=False,
-    ).model_dump()
-    new_id = create_document("instance", doc)
+    # Server-built document (see schemas.Instance); no need to re-validate it
+    doc = {
+        "user_id": user_id,
+        "name": payload.name,
+        "instance_id": instance_id,
+        "token": token,
+        "is_authenticated": False,
+    }
+    new_id = await create_document("instance", doc)
     return {"_id": new_id, "instance_id": instance_id, "token": token, "is_authenticated": False}
 
 
 @app.post("/instances/{instance_id}/authenticate")
-def authenticate_instance(instance_id: str, current_user: dict = Depends(get_current_user)):
-    inst = _collection("instance").find_one({"instance_id": instance_id, "user_id": str(current_user["_id"])})
+async def authenticate_instance(instance_id: str, user_id: str = Depends(get_current_user_id)):
+    inst = await _collection("instance").find_one({"instance_id": instance_id, "user_id": user_id})
     if not inst:
         raise HTTPException(status_code=404, detail="Instance not found")
-    _collection("instance").update_one({"_id": inst["_id"]}, {"$set": {"is_authenticated": True}})
+    await _collection("instance").update_one({"_id": inst["_id"]}, {"$set": {"is_authenticated": True}})
     return {"instance_id": instance_id, "is_authenticated": True}
 
 
 # ---------- Webhooks ----------
 
 @app.post("/webhooks/register")
-def register_webhook(payload: RegisterWebhook):
-    inst = _collection("instance").find_one({"instance_id": payload.instance_id})
-    if not inst or inst.get("token") != payload.token:
+async def register_webhook(payload: RegisterWebhook):
+    inst = await _collection("instance").find_one({"instance_id": payload.instance_id})
+    if not inst or not _secure_equals(inst.get("token"), payload.token):
         raise HTTPException(status_code=401, detail="Invalid instance credentials")
 
     doc = Webhook(instance_id=payload.instance_id, url=payload.url, events=payload.events or ["message.status", "message.incoming"]).model_dump()
-    new_id = create_document("webhook", doc)
+    new_id = await create_document("webhook", doc)
+    _hook_generation[payload.instance_id] = _hook_generation.get(payload.instance_id, 0) + 1
+    _hook_cache.pop(payload.instance_id, None)
     return {"_id": new_id, "message": "Webhook registered"}
 
 
 def _emit_webhook(instance_id: str, event: str, data: dict):
-    hooks = list(_collection("webhook").find({"instance_id": instance_id, "events": {"$in": [event]}}))
-    for h in hooks:
+    if webhook_q is None:
+        # Dispatch isn't running (not started or shutting down)
+        webhook_stats["dropped"] += 1
+        return
+    try:
+        webhook_q.put_nowait((instance_id, event, data))
+        webhook_stats["enqueued"] += 1
+    except asyncio.QueueFull:
+        # Best-effort; shed load rather than block the request
+        webhook_stats["dropped"] += 1
+
+
+# instance_id -> registered hooks (url + events). Webhooks change rarely, so a
+# short TTL bounds staleness across processes; register_webhook evicts locally.
+_hook_cache: TTLCache = TTLCache(maxsize=5000, ttl=30)
+# Bumped by register_webhook so a lookup that raced a registration doesn't
+# cache the pre-registration hook list
+_hook_generation: Dict[str, int] = {}
+
+
+async def _hooks_for_instance(instance_id: str) -> List[Dict[str, Any]]:
+    hooks = _hook_cache.get(instance_id)
+    if hooks is None:
+        generation = _hook_generation.get(instance_id, 0)
+        hooks = await _collection("webhook").find(
+            {"instance_id": instance_id}, {"_id": 0, "url": 1, "events": 1}
+        ).to_list(length=None)
+        if _hook_generation.get(instance_id, 0) == generation:
+            _hook_cache[instance_id] = hooks
+    return hooks
+
+
+async def _deliver_webhooks(batch: List[Tuple[str, str, dict]]):
+    # Resolve subscribers once per instance in the batch
+    instance_ids = list({instance_id for instance_id, _, _ in batch})
+    found = await asyncio.gather(*(_hooks_for_instance(i) for i in instance_ids), return_exceptions=True)
+    hooks_by_instance = {}
+    for instance_id, hooks in zip(instance_ids, found):
+        if isinstance(hooks, Exception):
+            # Events for this instance can't be routed; count them and carry on with the rest
+            logger.warning("Webhook lookup failed for instance %s: %s", instance_id, hooks)
+            webhook_stats["failed"] += sum(1 for i, _, _ in batch if i == instance_id)
+            hooks = []
+        hooks_by_instance[instance_id] = hooks
+
+    posts = [
+        http_client.post(h["url"], json={"event": event, "data": data})
+        for instance_id, event, data in batch
+        for h in hooks_by_instance[instance_id]
+        if event in h.get("events", ())
+    ]
+    results = await asyncio.gather(*posts, return_exceptions=True)
+    for r in results:
+        if isinstance(r, Exception) or r.is_error:
+            webhook_stats["failed"] += 1
+        else:
+            webhook_stats["delivered"] += 1
+
+
+async def _webhook_worker(queue: "asyncio.Queue[Tuple[str, str, dict]]"):
+    while True:
+        batch = [await queue.get()]
+        while len(batch) < WEBHOOK_BATCH_SIZE and not queue.empty():
+            batch.append(queue.get_nowait())
         try:
-            requests.post(h["url"], json={"event": event, "data": data}, timeout=3)
+            await _deliver_webhooks(batch)
         except Exception:
-            # Best-effort; ignore
-            pass
+            # Best-effort, but keep the worker alive and make the failure visible
+            logger.exception("Webhook delivery failed for a batch of %d events", len(batch))
+            webhook_stats["failed"] += len(batch)
+        finally:
+            for _ in batch:
+                queue.task_done()
 
 
 # ---------- Messages ----------
 
 @app.post("/messages/send")
-def send_message(payload: SendMessage):
-    inst = _collection("instance").find_one({"instance_id": payload.instance_id})
-    if not inst or inst.get("token") != payload.token:
+async def send_message(payload: SendMessage):
+    inst = await _collection("instance").find_one({"instance_id": payload.instance_id})
+    if not inst or not _secure_equals(inst.get("token"), payload.token):
         raise HTTPException(status_code=401, detail="Invalid instance credentials")
 
     msg_id = _random_token(12)
     status = "sent" if inst.get("is_authenticated") else "failed"
     error = None if status == "sent" else "Instance not authenticated (scan QR first)"
 
-    message_doc = Message(
-        instance_id=payload.instance_id,
-        to=payload.to,
-        type=(payload.type or "text"),
-        text=payload.text,
-        media_url=payload.media_url,
-        interactive=payload.interactive,
-        status=status,
-        error=error,
-        message_id=msg_id,
-    ).model_dump()
+    # Input was validated by SendMessage; build the stored document directly (see schemas.Message)
+    message_doc = {
+        "instance_id": payload.instance_id,
+        "to": payload.to,
+        "type": payload.type or "text",
+        "text": payload.text,
+        "media_url": payload.media_url,
+        "interactive": payload.interactive,
+        "status": status,
+        "error": error,
+        "message_id": msg_id,
+    }
 
-    create_document("message", message_doc)
+    await create_document("message", message_doc)
 
     # Simulate delivery progression for authenticated instances
     if status == "sent":
-        # queue simple state machine via best-effort webhooks (no async worker here)
+        # queued for the background webhook workers so the response isn't held up
         _emit_webhook(payload.instance_id, "message.status", {"message_id": msg_id, "status": "sent"})
 
     return {"message_id": msg_id, "status": status, "error": error}
 
 
 @app.get("/messages/{message_id}/status")
-def get_message_status(message_id: str):
-    msg = _collection("message").find_one({"message_id": message_id})
+async def get_message_status(message_id: str):
+    msg = await _collection("message").find_one({"message_id": message_id})
     if not msg:
         raise HTTPException(status_code=404, detail="Message not found")
     msg["_id"] = str(msg["_id"])  # stringify
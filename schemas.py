@@ -8,7 +8,7 @@ Each Pydantic model maps to a MongoDB collection whose name is the lowercase of
 - Webhook -> "webhook"
 """
 
-from pydantic import BaseModel, Field, EmailStr
+from pydantic import BaseModel, Field, EmailStr, PrivateAttr, model_validator
 from typing import Optional, List, Literal, Dict, Any
 from datetime import datetime
 
@@ -49,13 +49,30 @@ class Webhook(BaseModel):
 
 
 # Lightweight request models for validation (used only in FastAPI routes)
-class OTPRequest(BaseModel):
+class _OTPIdentity(BaseModel):
     email: Optional[EmailStr] = None
     phone: Optional[str] = None
 
-class OTPVerify(BaseModel):
-    email: Optional[EmailStr] = None
-    phone: Optional[str] = None
+    _identifier: Dict[str, str] = PrivateAttr(default_factory=dict)
+
+    @model_validator(mode="after")
+    def _resolve_identifier(self):
+        # Left empty when neither is given; routes answer that with a 400
+        if self.email:
+            self._identifier = {"email": self.email}
+        elif self.phone:
+            self._identifier = {"phone": self.phone}
+        return self
+
+    @property
+    def identifier(self) -> Dict[str, str]:
+        """User lookup filter: email if given, otherwise phone; empty if neither"""
+        return self._identifier
+
+class OTPRequest(_OTPIdentity):
+    pass
+
+class OTPVerify(_OTPIdentity):
     code: str
 
 class InstanceCreate(BaseModel):
@@ -65,7 +82,7 @@ class SendMessage(BaseModel):
     instance_id: str
     token: str
     to: str
-    type: Optional[str] = "text"
+    type: Optional[Literal["text", "image", "document", "audio", "video", "interactive"]] = "text"
     text: Optional[str] = None
     media_url: Optional[str] = None
     interactive: Optional[Dict[str, Any]] = None